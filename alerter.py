@@ -9,108 +9,260 @@ Alerter just reads and decides:
 """
 
 import json
+import os
 import sys
 import psycopg2
-import time
+from psycopg2 import sql
+try:
+    import orjson  # Optional: much faster JSON parsing/serialization
+except ImportError:
+    orjson = None
+from collections import Counter
 from datetime import datetime
 
 class Alerter:
     """Dumb alerter - just reads stats and decides YES/NO"""
     
+    # Full scan of orders = what an index build has to read (costs only, no timing)
+    _CREATE_COST_EXPLAIN_SQL = "EXPLAIN (FORMAT JSON, COSTS TRUE, TIMING FALSE) SELECT COUNT(*) FROM orders"
+    
     def __init__(self, db_config, improvement_threshold=20, max_space_budget_mb=500):
         self.conn = psycopg2.connect(**db_config)
+        # Autocommit: skips the separate BEGIN round-trip psycopg2 sends before each
+        # transaction. Every statement here is a read, a self-contained batch or an
+        # explicit BEGIN ... ROLLBACK block (see measure_all_sizes).
+        self.conn.autocommit = True
         self.improvement_threshold = improvement_threshold  # percent (configurable)
         self.max_space_budget = max_space_budget_mb * 1_000_000  # Convert MB to bytes
+        self._has_hypopg = None  # Lazily checked in has_hypopg()
+        self._create_cost = None  # Cached by estimate_create_index_cost()
+        self._idx_counter = 0  # Suffix for temp index names (unique per batch)
     
-    def get_existing_indexes(self):
+    def get_existing_indexes(self, cur=None):
         """Get list of existing indexes (do NOT recommend creating them again)"""
+        if cur is None:
+            with self.conn.cursor() as cur:
+                return self.get_existing_indexes(cur)
         existing = set()
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT schemaname, tablename, indexname 
-                FROM pg_indexes 
-                WHERE tablename = 'orders' AND schemaname = 'public'
-            """)
-            for schema, table, idx in cur.fetchall():
-                # Extract column from index name (e.g., idx_o_custkey -> o_custkey)
-                if 'idx_' in idx:
-                    col = idx.replace('idx_', '').replace('idx_opt_', '')
-                    existing.add(col)
+        cur.execute("""
+            SELECT schemaname, tablename, indexname 
+            FROM pg_indexes 
+            WHERE tablename = 'orders' AND schemaname = 'public'
+        """)
+        for schema, table, idx in cur.fetchall():
+            # Extract column from index name (e.g., idx_o_custkey -> o_custkey)
+            if 'idx_' in idx:
+                col = idx.replace('idx_', '').replace('idx_opt_', '')
+                existing.add(col)
         return existing
     
-    def get_real_index_size(self, column):
-        """Calculate real index size by creating temp index and checking its size
+    def has_hypopg(self, cur=None):
+        """Check whether the HypoPG extension is installed in this database"""
+        if self._has_hypopg is None:
+            if cur is None:
+                with self.conn.cursor() as cur:
+                    return self.has_hypopg(cur)
+            try:
+                cur.execute("SELECT extname FROM pg_extension WHERE extname = 'hypopg'")
+                self._has_hypopg = cur.fetchone() is not None
+            except Exception as e:
+                print(f"    Warning: Could not check for hypopg: {e}")
+                self._has_hypopg = False
+        return self._has_hypopg
+    
+    @staticmethod
+    def _btree_size_from_stats(reltuples, avg_width):
+        """B-tree size estimate: (column data + 12 bytes tuple header/line pointer) per row,
+        plus ~30% for page fill factor and inner pages"""
+        return int(reltuples * (avg_width + 12)) * 13 // 10
+    
+    def get_real_index_sizes(self, columns, cur=None):
+        """Calculate index sizes for all candidate columns in one batch
         
-        Creates a temporary index, measures its actual disk size using pg_relation_size(),
-        then immediately drops it. No permanent changes to the database.
+        Uses HypoPG hypothetical indexes (planner memory only, no disk writes or locks)
+        and hypopg_relation_size() when the extension is available. Otherwise falls back
+        to creating temporary indexes, measuring them with pg_relation_size() and dropping them.
+        Returns a dict: column -> size in bytes.
         """
-        try:
+        if not columns:
+            return {}
+        if cur is None:
             with self.conn.cursor() as cur:
-                # Create a temporary index
-                temp_idx_name = f"temp_idx_size_{column}_{int(time.time() * 1000000)}"
-                try:
-                    cur.execute(f"CREATE INDEX {temp_idx_name} ON orders ({column})")
-                    self.conn.commit()
-                    
-                    # Get size in bytes
-                    cur.execute(f"""
-                        SELECT pg_relation_size('{temp_idx_name}'::regclass)
-                    """)
-                    result = cur.fetchone()
-                    size_bytes = result[0] if result else 5_000_000
-                    
-                    # Drop temp index immediately
-                    cur.execute(f"DROP INDEX {temp_idx_name}")
-                    self.conn.commit()
-                    
-                    return size_bytes
-                except Exception as e:
-                    print(f"    Warning: Could not measure size for {column}: {e}")
-                    # Fallback to estimate
-                    return 5_000_000
+                return self.get_real_index_sizes(columns, cur)
+        if not self.has_hypopg(cur):
+            return self.measure_all_sizes(columns, cur)
+        try:
+            # One round-trip: create every hypothetical index and read its size
+            cur.execute("""
+                SELECT c.col, hypopg_relation_size(h.indexrelid)
+                FROM unnest(%s::text[]) AS c(col)
+                CROSS JOIN LATERAL hypopg_create_index('CREATE INDEX ON orders (' || quote_ident(c.col) || ')') h
+            """, (list(columns),))
+            sizes = dict(cur.fetchall())
+            cur.execute("SELECT hypopg_reset()")
+            return {col: sizes.get(col, 5_000_000) for col in columns}
         except Exception as e:
-            print(f"    Warning: Could not create temp index for {column}: {e}")
-            return 5_000_000
+            print(f"    Warning: Could not measure hypothetical sizes for {', '.join(columns)}: {e}")
+            return {col: 5_000_000 for col in columns}
     
-    def estimate_create_index_cost(self):
-        """Estimate cost to CREATE index"""
+    def measure_all_sizes(self, columns, cur=None):
+        """Measure real index sizes by creating temp indexes and checking their size
+        
+        Creates all temporary indexes inside ONE transaction, measures their actual disk
+        size using pg_relation_size() in a single query, then ROLLBACKs - the indexes are
+        discarded without DROP statements or commits. No permanent changes to the database.
+        """
+        if cur is None:
+            with self.conn.cursor() as cur:
+                return self.measure_all_sizes(columns, cur)
+        self._idx_counter += 1
+        temp_names = {col: f"temp_idx_size_{col}_{self._idx_counter}" for col in columns}
         try:
+            cur.execute(sql.SQL("BEGIN;") + sql.SQL(";").join(
+                sql.SQL("CREATE INDEX {} ON orders ({})").format(sql.Identifier(name), sql.Identifier(col))
+                for col, name in temp_names.items()
+            ))
+            
+            # Get all sizes in bytes
+            cur.execute("""
+                SELECT indexname, pg_relation_size(indexname::regclass)
+                FROM pg_indexes
+                WHERE indexname = ANY(%s)
+            """, (list(temp_names.values()),))
+            sizes = dict(cur.fetchall())
+            
+            return {col: sizes.get(name, 5_000_000) for col, name in temp_names.items()}
+        except Exception as e:
+            print(f"    Warning: Could not measure sizes for {', '.join(columns)}: {e}")
+            # Fallback to estimate
+            return {col: 5_000_000 for col in columns}
+        finally:
+            # Discard the temp indexes (also clears an aborted transaction)
+            cur.execute("ROLLBACK")
+    
+    def estimate_create_index_cost(self, cur=None):
+        """Estimate cost to CREATE index (cached - the EXPLAIN is constant for a run)"""
+        if self._create_cost is None:
+            self._create_cost = self._compute_create_cost(cur)
+        return self._create_cost
+    
+    def _compute_create_cost(self, cur=None):
+        """Run EXPLAIN on a full scan of orders to estimate index build cost"""
+        if cur is None:
             with self.conn.cursor() as cur:
-                cur.execute("EXPLAIN (FORMAT JSON) SELECT COUNT(*) FROM orders")
-                result = cur.fetchone()
-                if result:
-                    plan = result[0]
-                    return float(plan[0]['Plan']['Total Cost'])
-        except:
-            pass
-        return 1000  # Fallback
+                return self._compute_create_cost(cur)
+        try:
+            cur.execute(self._CREATE_COST_EXPLAIN_SQL)
+            result = cur.fetchone()
+            if result:
+                plan = result[0]
+                return float(plan[0]['Plan']['Total Cost'])
+        except psycopg2.Error as e:
+            print(f"    Warning: Could not estimate index build cost: {e}")
+        return 1000.0  # Fallback
+    
+    def estimate_drop_index_cost(self, create_cost=None, cur=None):
+        """Estimate cost to DROP index (pass create_cost to reuse an existing estimate)"""
+        if create_cost is None:
+            create_cost = self.estimate_create_index_cost(cur)
+        return create_cost * 0.2
     
-    def estimate_drop_index_cost(self):
-        """Estimate cost to DROP index"""
-        return self.estimate_create_index_cost() * 0.2
+    def fetch_tuning_inputs(self, columns, cur=None):
+        """Fetch create cost, drop cost and size estimate for all candidates in ONE query
+        
+        Build cost comes from pg_class page/tuple counts (what EXPLAIN charges for a full
+        scan of orders) and size from reltuples and pg_stats.avg_width, so no EXPLAIN or DDL
+        is needed. Columns without planner statistics fall back to get_real_index_sizes().
+        Returns a dict: column -> (create_cost, drop_cost, size_bytes)
+        """
+        if not columns:
+            return {}
+        if cur is None:
+            with self.conn.cursor() as cur:
+                return self.fetch_tuning_inputs(columns, cur)
+        rows = []
+        try:
+            cur.execute("""
+                SELECT c.relpages * current_setting('seq_page_cost')::float
+                         + c.reltuples * current_setting('cpu_tuple_cost')::float,
+                       c.reltuples, s.attname, s.avg_width
+                FROM pg_class c
+                LEFT JOIN pg_stats s ON s.schemaname = 'public'
+                    AND s.tablename = c.relname
+                    AND s.attname = ANY(%s)
+                WHERE c.oid = 'public.orders'::regclass
+            """, (list(columns),))
+            rows = cur.fetchall()
+        except Exception as e:
+            print(f"    Warning: Could not read planner statistics: {e}")
+        
+        build_cost = rows[0][0] if rows else None
+        create_cost = build_cost if build_cost and build_cost > 0 else self.estimate_create_index_cost(cur)
+        drop_cost = self.estimate_drop_index_cost(create_cost)
+        
+        index_sizes = {
+            attname: self._btree_size_from_stats(reltuples, avg_width)
+            for _, reltuples, attname, avg_width in rows
+            if attname is not None and avg_width is not None and reltuples > 0
+        }
+        missing = [col for col in columns if col not in index_sizes]
+        if missing:
+            index_sizes.update(self.get_real_index_sizes(missing, cur))
+        
+        return {col: (create_cost, drop_cost, index_sizes[col]) for col in columns}
     
     def load_workload_stats(self, workload_id):
         """Load stats file for workload"""
         filename = f"workload_{workload_id}_stats.json"
         try:
-            with open(filename, 'r') as f:
-                return json.load(f)
+            with open(filename, 'rb') as f:
+                data = f.read()
+            return orjson.loads(data) if orjson else json.loads(data)
         except FileNotFoundError:
             return None
     
-    def extract_hot_columns_from_measurements(self, measurements):
-        """Extract hot columns from measurements (already collected by workload)"""
-        column_counts = {}
-        for m in measurements:
-            hot_cols = m.get('hot_columns', [])
-            for col in hot_cols:
-                column_counts[col] = column_counts.get(col, 0) + 1
-        
-        # Sort by frequency
-        return sorted(column_counts.items(), key=lambda x: x[1], reverse=True)
+    def measurements_to_queries(self, measurements):
+        """Adapt the old measurements list to the queries dict schema (one entry per measurement)"""
+        return {
+            str(i): {
+                'total_baseline_cost': m.get('baseline_cost', 0),
+                'total_optimized_cost': m.get('optimized_cost', 0),
+                'avg_improvement_pct': m.get('improvement_pct', 0),
+                'hot_columns': m.get('hot_columns', []),
+            }
+            for i, m in enumerate(measurements)
+        }
+    
+    def aggregate_queries(self, queries_dict, min_improvement_pct=None):
+        """Aggregate per-query stats in a single pass (pure - no DB access or printing)
+        
+        Queries whose avg_improvement_pct is below min_improvement_pct are cold (indexes
+        barely help them) and are skipped, so they affect neither costs nor hot columns.
+        With min_improvement_pct=None every query is aggregated.
+        Returns (total_baseline_cost, total_improvement_cost, improvement_pcts, hot_columns_counter)
+        """
+        total_baseline_cost = 0
+        total_optimized_cost = 0
+        improvement_pcts = []
+        hot_columns_counter = Counter()
+        for query_data in queries_dict.values():
+            improvement_pct = query_data.get('avg_improvement_pct', 0)
+            if min_improvement_pct is not None and improvement_pct < min_improvement_pct:
+                continue
+            total_baseline_cost += query_data.get('total_baseline_cost', 0)
+            total_optimized_cost += query_data.get('total_optimized_cost', 0)
+            improvement_pcts.append(improvement_pct)
+            hot_columns_counter.update(query_data.get('hot_columns', ()))
+        return (total_baseline_cost, total_baseline_cost - total_optimized_cost,
+                improvement_pcts, hot_columns_counter)
     
     def analyze_workload(self, workload_id):
-        """Analyze stats and make decision"""
+        """Analyze stats and make decision (one cursor shared by every DB helper)"""
+        with self.conn.cursor() as cur:
+            return self._analyze_workload(workload_id, cur)
+    
+    def _analyze_workload(self, workload_id, cur):
+        """Analyze stats and make decision using the given cursor"""
         print(f"\n{'='*80}")
         print(f"ALERTER ANALYSIS - Workload {workload_id}")
         print(f"Time: {datetime.now().isoformat()}")
@@ -140,39 +292,19 @@ class Alerter:
         print(f"  - Phases completed: {stats.get('phases_completed', 0)}")
         print(f"  - Last update: {stats.get('last_update', 'unknown')}")
         
-        # Calculate stats from queries dict (new format)
-        total_baseline_cost = 0
-        total_improvement_cost = 0  # How much we save with indexes
-        all_improvement_pcts = []
-        hot_columns_all_dict = {}
+        # Old measurements format goes through the same aggregation as the queries dict
+        if not queries_dict:
+            queries_dict = self.measurements_to_queries(measurements)
         
-        if queries_dict:
-            for query_key, query_data in queries_dict.items():
-                baseline = query_data.get('total_baseline_cost', 0)
-                optimized = query_data.get('total_optimized_cost', 0)
-                improvement_pct = query_data.get('avg_improvement_pct', 0)
-                hot_cols = query_data.get('hot_columns', [])
-                
-                total_baseline_cost += baseline
-                total_improvement_cost += (baseline - optimized)
-                all_improvement_pcts.append(improvement_pct)
-                
-                # Count hot columns
-                for col in hot_cols:
-                    hot_columns_all_dict[col] = hot_columns_all_dict.get(col, 0) + 1
-        else:
-            # Fallback to old measurements format
-            for m in measurements:
-                baseline = m.get('baseline_cost', 0)
-                optimized = m.get('optimized_cost', 0)
-                improvement_pct = m.get('improvement_pct', 0)
-                
-                total_baseline_cost += baseline
-                total_improvement_cost += (baseline - optimized)
-                all_improvement_pcts.append(improvement_pct)
-        
-        # Calculate average improvement
-        avg_improvement_pct = sum(all_improvement_pcts) / len(all_improvement_pcts) if all_improvement_pcts else 0
+        # Skip cold queries: less than half the threshold improvement
+        cold_cutoff = self.improvement_threshold * 0.5
+        (total_baseline_cost, total_improvement_cost,  # improvement = how much we save with indexes
+         all_improvement_pcts, hot_columns_counter) = self.aggregate_queries(queries_dict, cold_cutoff)
+        print(f"  - Queries analyzed (improvement >= {cold_cutoff:.1f}%): {len(all_improvement_pcts)}")
+        
+        # Calculate average improvement over ALL queries (cold ones only stay out of the sums)
+        avg_improvement_pct = (sum(q.get('avg_improvement_pct', 0) for q in queries_dict.values()) /
+                               len(queries_dict)) if queries_dict else 0
         
         print(f"\nMeasured Statistics:")
         print(f"  - Total baseline cost (all queries, no indexes): {total_baseline_cost:.2f}")
@@ -180,19 +312,31 @@ class Alerter:
         print(f"  - Total improvement value: {total_improvement_cost:.2f}")
         print(f"  - Average improvement per query: {avg_improvement_pct:.2f}%")
         
+        if not all_improvement_pcts:
+            print(f"\n   No query reaches the cold cutoff")
+            recommendation = {
+                'timestamp': datetime.now().isoformat(),
+                'workload_id': workload_id,
+                'decision': 'NO_ACTION',
+                'reason': f"No query reaches the cold cutoff ({cold_cutoff:.1f}% improvement)",
+                'improvement_pct': round(avg_improvement_pct, 2),
+                'improvement_value': round(total_improvement_cost, 2),
+                'retuning_cost': 0,
+                'net_benefit': 0,
+                'recommended_indexes': []
+            }
+            return recommendation
+        
         # Get existing indexes
-        existing = self.get_existing_indexes()
+        existing = self.get_existing_indexes(cur)
         print(f"\nExisting indexes (skip these):")
         if existing:
             print(f"  - {', '.join(sorted(existing))}")
         else:
             print(f"  - None")
         
-        # Extract hot columns (from dict if available)
-        if hot_columns_all_dict:
-            hot_columns_all = sorted(hot_columns_all_dict.items(), key=lambda x: x[1], reverse=True)
-        else:
-            hot_columns_all = self.extract_hot_columns_from_measurements(measurements)
+        # Hot columns sorted by frequency
+        hot_columns_all = hot_columns_counter.most_common()
         
         candidates = [col for col, count in hot_columns_all if col not in existing][:3]  # Top 3 new indexes
         
@@ -217,14 +361,10 @@ class Alerter:
             return recommendation
         
         # Calculate retuning cost (CREATE + DROP for each new index)
-        total_retuning_cost = 0
-        index_sizes = {}
-        for col in candidates:
-            create_cost = self.estimate_create_index_cost()
-            drop_cost = self.estimate_drop_index_cost()
-            size = self.get_real_index_size(col)  # Get REAL index size
-            index_sizes[col] = size
-            total_retuning_cost += create_cost + drop_cost
+        # All planner inputs (create/drop cost, size) for every candidate in one query
+        tuning_inputs = self.fetch_tuning_inputs(candidates, cur)
+        total_retuning_cost = sum(create + drop for create, drop, _ in tuning_inputs.values())
+        index_sizes = {col: size for col, (_, _, size) in tuning_inputs.items()}
         
         # Net benefit
         net_benefit = total_improvement_cost - total_retuning_cost
@@ -297,8 +437,15 @@ class Alerter:
     def save_recommendation(self, workload_id, recommendation):
         """Save recommendation to file"""
         filename = f"workload_{workload_id}_alert.json"
-        with open(filename, 'w') as f:
-            json.dump(recommendation, f, indent=2, default=str)
+        if orjson:
+            data = orjson.dumps(recommendation, default=str, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(recommendation, indent=2, default=str).encode()
+        # Write to a temp file and rename so a crash never leaves a half-written alert
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
         print(f"  Recommendation saved: {filename}\n")
     
     def close(self):
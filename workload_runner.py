@@ -1,25 +1,43 @@
 """
 Workload Runner - Collects BASELINE and OPTIMIZED costs
 BASELINE: Query cost without hypothetical indexes
-OPTIMIZED: Query cost with ALL POSSIBLE hypothetical index combinations
+OPTIMIZED: Query cost with greedily selected hypothetical indexes
 
 Supports ANY database, ANY query (including JOINs)
 Extracts tables and columns from query automatically
-Creates all combinations and lets EXPLAIN pick the best
+Selects indexes greedily by cost reduction per byte (AutoAdmin-style)
 """
 
 import psycopg2
+from psycopg2.extras import register_default_json
 import json
+try:
+    import orjson  # Optional: much faster parsing of EXPLAIN JSON and stats writes
+except ImportError:
+    orjson = None
+else:
+    # EXPLAIN (FORMAT JSON) returns a json column; decode it with orjson on every connection
+    register_default_json(globally=True, loads=orjson.loads)
 import time
-import itertools
+from array import array
 import re
 from datetime import datetime
 import sys
 
+# Compiled once: FROM table_name / JOIN table_name / table.column
+_FROM_RE = re.compile(r'FROM\s+(\w+)', re.IGNORECASE)
+_JOIN_RE = re.compile(r'JOIN\s+(\w+)', re.IGNORECASE)
+_QUALIFIED_COL_RE = re.compile(r'\b(\w+)\.(\w+)\b')
+
 class WorkloadRunner:
     def __init__(self, db_config, workload_id):
         self.conn = psycopg2.connect(**db_config)
+        # Autocommit: every statement is a read or a HypoPG call, so there is nothing to
+        # commit. This also saves the implicit BEGIN and the COMMIT round-trips. HypoPG
+        # indexes are session state and are not affected by transaction boundaries.
+        self.conn.autocommit = True
         self.workload_id = workload_id
+        self._load_hypopg()
         self.stats = {
             'workload_id': workload_id,
             'run_time': datetime.now().isoformat(),
@@ -28,40 +46,73 @@ class WorkloadRunner:
             'hot_columns': [],
             'last_save': datetime.now().isoformat()
         }
-        self.query_hash_map = {}  # Map: query -> aggregated stats
+        # Fresh cost measurements, appended as JSON lines (line-buffered)
+        self.events_file = open(f"workload_{workload_id}_events.jsonl", 'a', buffering=1)
         self.existing_indexes = self._get_existing_indexes()  # Cache existing indexes
+        self._baseline_cache = {}  # query -> baseline cost (cleared at the start of each phase)
+        # query -> (measured_at, baseline_cost, optimized_cost, used_indexes, used_size_bytes)
+        self._result_cache = {}
+        self.result_ttl_sec = 60  # Re-measure a query after this long even within a phase
+        self.iteration_interval_sec = 0.1  # One pass over the phase's queries per interval
+        self._table_columns = {}  # table -> set of column names (see _get_table_columns)
+        self.index_budget_bytes = 256 * 1024 * 1024  # Storage budget per query for greedy selection
+        self.min_gain_pct = 1.0  # Stop selecting once the best candidate saves less than this
+        self.cost_floor = 1000.0  # Skip hypothetical indexes for queries cheaper than this
+        self.index_info = {}  # query -> {'all_created': [...], 'used_by_query': [...]}
+        self._used_index_keys = {}  # query_key -> {(table, columns)} already in entry['used_indexes']
+        # Per-query numeric aggregates as typed columns indexed by qid; copied into
+        # self.stats['queries'] only when stats are saved (see _flush_aggregates)
+        self._qids = {}  # query_key -> qid
+        self._agg_executions = array('q')
+        self._agg_baseline = array('d')
+        self._agg_optimized = array('d')
+        self._agg_min_imp = array('d')
+        self._agg_max_imp = array('d')
+        self._agg_index_size = array('q')
+        # Phase-wide hypothetical index set (see prepare_phase_candidates)
+        self._query_specs = {}  # query -> [(table, columns), ...]
+        self._phase_specs = []  # Deduplicated union over all queries of the phase
+        self._phase_spec_keys = set()
+        # Phase set as created on self.conn: [(oid, name, size, columns, table), ...],
+        # None while it isn't there (built lazily by _ensure_phase_indexes)
+        self._phase_index_info = None
+    
+    def _load_hypopg(self):
+        """Make sure the hypopg extension is available (once per runner, not per query)"""
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("CREATE EXTENSION IF NOT EXISTS hypopg")
+        except Exception as e:
+            print(f"Warning: Could not load hypopg: {e}")
     
     def _get_existing_indexes(self):
-        """Get list of columns that already have indexes"""
-        existing = set()
+        """Get the already indexed columns of every table as {table: frozenset(columns)}"""
+        existing = {}
         try:
             with self.conn.cursor() as cur:
-                # Get all indexed columns on the orders table
+                # One catalog scan for all ordinary tables (no join on the index relation)
                 cur.execute("""
-                    SELECT a.attname
+                    SELECT c.relname, a.attname
                     FROM pg_index i
                     JOIN pg_attribute a ON a.attrelid = i.indrelid
                         AND a.attnum = ANY(i.indkey)
-                    JOIN pg_class t ON t.oid = i.indrelid
-                    JOIN pg_class idx ON idx.oid = i.indexrelid
-                    WHERE t.relname = 'orders'
+                    JOIN pg_class c ON c.oid = i.indrelid
+                    WHERE c.relkind = 'r'
                 """)
-                for row in cur.fetchall():
-                    existing.add(row[0])
+                for table, column in cur.fetchall():
+                    existing.setdefault(table, set()).add(column)
         except Exception as e:
             print(f"Warning: Could not get existing indexes: {e}")
-        return existing
+        return {table: frozenset(cols) for table, cols in existing.items()}
     
     def extract_tables_from_query(self, query):
         """Extract table names from query (FROM, JOIN clauses)"""
         tables = set()
         # Match FROM table_name
-        from_pattern = r'FROM\s+(\w+)'
-        tables.update(re.findall(from_pattern, query, re.IGNORECASE))
+        tables.update(_FROM_RE.findall(query))
         
         # Match JOIN table_name
-        join_pattern = r'JOIN\s+(\w+)'
-        tables.update(re.findall(join_pattern, query, re.IGNORECASE))
+        tables.update(_JOIN_RE.findall(query))
         
         return list(tables)
     
@@ -71,8 +122,7 @@ class WorkloadRunner:
         
         # Match table-qualified columns (e.g., o.o_orderkey, l.l_quantity)
         # Pattern: word.word (table.column)
-        qualified_col_pattern = r'\b(\w+)\.(\w+)\b'
-        matches = re.findall(qualified_col_pattern, query)
+        matches = _QUALIFIED_COL_RE.findall(query)
         for table_alias, col_name in matches:
             # Skip functions and keywords
             if col_name.lower() not in ['*', 'count', 'sum', 'max', 'min', 'avg', 'date', 'extract', 'cast']:
@@ -81,164 +131,328 @@ class WorkloadRunner:
         return list(columns) if columns else []
     
     def get_baseline_cost(self, query):
-        """Get BASELINE cost: query without new indexes"""
+        """Get BASELINE cost: query without new indexes (cached per query for the phase)
+        
+        Measured without hypothetical indexes: if the phase set is in the session it is
+        cleared first (and rebuilt on the next get_optimized_cost()).
+        """
+        if query in self._baseline_cache:
+            return self._baseline_cache[query]
         try:
             with self.conn.cursor() as cur:
+                if self._phase_index_info is not None:
+                    cur.execute("SELECT hypopg_reset()")
+                    self._phase_index_info = None
                 cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
                 result = cur.fetchone()
                 if result and result[0]:
                     plan = result[0]
-                    return float(plan[0]['Plan']['Total Cost'])
-        except Exception as e:
+                    cost = float(plan[0]['Plan']['Total Cost'])
+                    self._baseline_cache[query] = cost
+                    return cost
+        except psycopg2.Error:
+            pass  # e.g. undefined table/column: no baseline for this query
+        return None
+    
+    def _get_table_columns(self, cur, tables):
+        """Get {table: set of column names} for tables (cached - schema is fixed during a run)"""
+        missing = [table for table in tables if table not in self._table_columns]
+        if missing:
+            try:
+                cur.execute("""
+                    SELECT c.relname, a.attname
+                    FROM pg_attribute a
+                    JOIN pg_class c ON c.oid = a.attrelid
+                    WHERE c.relname = ANY(%s) AND a.attnum > 0 AND NOT a.attisdropped
+                """, (missing,))
+                for table in missing:
+                    self._table_columns[table] = set()
+                for table, column in cur.fetchall():
+                    self._table_columns[table].add(column)
+            except Exception as e:
+                print(f"Warning: Could not get columns for {', '.join(missing)}: {e}")
+        return self._table_columns
+    
+    def _create_hypothetical_indexes(self, cur, specs):
+        """Create hypothetical indexes for [(table, columns), ...] in ONE round-trip
+        
+        Each index is created with hypopg_create_index() and sized with
+        hypopg_relation_size() in the same statement.
+        Returns list of (oid, index_name, size_bytes, columns, table).
+        """
+        if not specs:
+            return []
+        ddls = [f"CREATE INDEX ON {table} ({', '.join(cols)})" for table, cols in specs]
+        try:
+            cur.execute("""
+                SELECT d.ord, h.indexrelid, h.indexname, hypopg_relation_size(h.indexrelid)
+                FROM unnest(%s::text[]) WITH ORDINALITY AS d(stmt, ord)
+                CROSS JOIN LATERAL hypopg_create_index(d.stmt) h
+            """, (ddls,))
+            rows = cur.fetchall()
+        except psycopg2.Error:
+            return []
+        hyp_index_info = []
+        for ord, oid, index_name, index_size in rows:
+            table, cols = specs[ord - 1]
+            hyp_index_info.append((oid, index_name, index_size or 0, cols, table))
+        return hyp_index_info
+    
+    def _drop_hypothetical_indexes(self, cur, oids):
+        """Drop hypothetical indexes by oid in ONE round-trip"""
+        if not oids:
+            return
+        try:
+            cur.execute("SELECT hypopg_drop_index(oid) FROM unnest(%s::oid[]) AS t(oid)", (oids,))
+        except psycopg2.Error:
+            pass
+    
+    def _collect_index_names(self, node, out):
+        """Collect every 'Index Name' in an EXPLAIN JSON plan node and its children"""
+        index_name = node.get('Index Name')
+        if index_name is not None:
+            out.add(index_name)
+        for child in node.get('Plans', ()):
+            self._collect_index_names(child, out)
+    
+    def _explain_total_cost(self, cur, query):
+        """Run EXPLAIN on query with the current hypothetical indexes, return Total Cost"""
+        try:
+            cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
+            result = cur.fetchone()
+            if result and result[0]:
+                return float(result[0][0]['Plan']['Total Cost'])
+        except psycopg2.Error:
             pass
         return None
     
-    def get_optimized_cost(self, query, tables, columns):
-        """Get OPTIMIZED cost with hypothetical indexes on NEW (non-indexed) columns only
+    def _candidate_specs(self, cur, query, tables, columns, baseline_cost):
+        """Select the hypothetical index candidates for one query as [(table, columns), ...]
+        
+        AutoAdmin-style greedy selection: starting from no indexes, each step tries every
+        remaining single-column index and every one-column extension of a selected index
+        (in place of that index) on top of the current selection, and keeps the one with
+        the largest cost reduction per byte. Stops when no candidate saves at least min_gain_pct of the baseline cost
+        or the next one would exceed index_budget_bytes. Must run in a session without
+        other hypothetical indexes.
+        """
+        # Filter: only get columns that DON'T have an existing index on some table
+        indexed = {table: self.existing_indexes.get(table, frozenset()) for table in tables}
+        new_columns = [col for col in columns
+                       if any(col not in indexed[table] for table in tables)]
+        if not tables or not new_columns:
+            return []
+        
+        table_columns = self._get_table_columns(cur, tables)
+        singles = [(table, [col]) for col in new_columns for table in tables
+                   if col in table_columns.get(table, ()) and col not in indexed[table]]
+        min_gain = baseline_cost * self.min_gain_pct / 100
+        selected = []  # [(table, columns), oid, size_bytes], kept as hypothetical indexes while searching
+        selected_keys = set()
+        current_cost = baseline_cost
+        total_size = 0
+        
+        while True:
+            # Remaining singles plus one-column extensions (up to 3 columns) of the selection,
+            # as (spec, position of the selected index it replaces or None)
+            candidates = [(spec, None) for spec in singles if (spec[0], tuple(spec[1])) not in selected_keys]
+            for pos, ((table, cols), _, _) in enumerate(selected):
+                if len(cols) >= 3:
+                    continue
+                for col in new_columns:
+                    if (col not in cols and col in table_columns.get(table, ())
+                            and col not in indexed[table]):
+                        extended = cols + [col]
+                        if (table, tuple(extended)) not in selected_keys:
+                            candidates.append(((table, extended), pos))
+            
+            # Evaluate each candidate on top of the current selection (an extension in
+            # place of the index it extends)
+            best = None  # (gain_per_byte, spec, replaced position, cost, size_bytes)
+            for spec, replaced in candidates:
+                replaced_size = 0
+                if replaced is not None:
+                    replaced_spec, replaced_oid, replaced_size = selected[replaced]
+                    self._drop_hypothetical_indexes(cur, [replaced_oid])
+                info = self._create_hypothetical_indexes(cur, [spec])
+                cost = self._explain_total_cost(cur, query) if info else None
+                if info:
+                    self._drop_hypothetical_indexes(cur, [info[0][0]])
+                if replaced is not None:
+                    restored = self._create_hypothetical_indexes(cur, [replaced_spec])
+                    if restored:
+                        selected[replaced][1] = restored[0][0]
+                if cost is None:
+                    continue
+                size = info[0][2]
+                if total_size - replaced_size + size > self.index_budget_bytes:
+                    continue
+                gain = current_cost - cost
+                if gain <= 0 or gain < min_gain:
+                    continue
+                gain_per_byte = gain / max(size, 1)
+                if best is None or gain_per_byte > best[0]:
+                    best = (gain_per_byte, spec, replaced, cost, size)
+            if best is None:
+                break
+            
+            # Keep the winner for the next step (an extension drops the index it extends)
+            _, spec, replaced, cost, size = best
+            if replaced is not None:
+                replaced_spec, replaced_oid, replaced_size = selected.pop(replaced)
+                selected_keys.discard((replaced_spec[0], tuple(replaced_spec[1])))
+                self._drop_hypothetical_indexes(cur, [replaced_oid])
+                total_size -= replaced_size
+            info = self._create_hypothetical_indexes(cur, [spec])
+            if not info:
+                break
+            selected.append([spec, info[0][0], size])
+            selected_keys.add((spec[0], tuple(spec[1])))
+            current_cost = cost
+            total_size += size
+        
+        self._drop_hypothetical_indexes(cur, [oid for _, oid, _ in selected])
+        return [spec for spec, _, _ in selected]
+    
+    def prepare_phase_candidates(self, prepared):
+        """Build ONE deduplicated hypothetical index set for all queries of a phase
         
-        Only creates indexes on columns that DON'T already have real indexes.
-        This shows the real improvement potential of new indexes.
-        Also captures hypothetical index sizes using hypopg_relation_size().
-        Tracks WHICH indexes were actually used by the planner in the EXPLAIN plan.
-        Hypothetical indexes must be used in same session before drop.
+        prepared: [(query, tables, columns), ...]. Ranking runs in a clean session; the
+        union set is then created once by _ensure_phase_indexes() and reused for every
+        EXPLAIN in the phase, instead of creating and dropping the same indexes on every
+        iteration.
+        """
+        self._query_specs = {}
+        self._phase_specs = []
+        self._phase_spec_keys = set()
+        self._add_phase_candidates(prepared)
+    
+    def _add_phase_candidates(self, prepared):
+        """Rank candidates for more queries and add them to the current phase set"""
+        with self.conn.cursor() as cur:
+            # Ranking needs a clean session; the phase set is recreated on next use
+            try:
+                cur.execute("SELECT hypopg_reset()")
+            except psycopg2.Error:
+                pass
+            self._phase_index_info = None
+            for query, tables, columns in prepared:
+                baseline_cost = self.get_baseline_cost(query)
+                if baseline_cost is None or baseline_cost < self.cost_floor:
+                    continue
+                specs = self._candidate_specs(cur, query, tables, columns, baseline_cost)
+                self._query_specs[query] = specs
+                for table, cols in specs:
+                    key = (table, tuple(cols))
+                    if key not in self._phase_spec_keys:
+                        self._phase_spec_keys.add(key)
+                        self._phase_specs.append((table, cols))
+    
+    def _ensure_phase_indexes(self, cur):
+        """Make sure the session holds the current phase's hypothetical indexes
+        
+        Created once per phase (one batched round-trip after a hypopg_reset).
+        Returns list of (oid, index_name, size_bytes, columns, table).
+        """
+        if self._phase_index_info is None:
+            try:
+                cur.execute("SELECT hypopg_reset()")
+            except psycopg2.Error:
+                pass
+            self._phase_index_info = self._create_hypothetical_indexes(cur, self._phase_specs)
+        return self._phase_index_info
+    
+    def get_optimized_cost(self, query, tables, columns, baseline_cost=None):
+        """Get OPTIMIZED cost: EXPLAIN with the phase's hypothetical indexes in place
+        
+        Queries not prepared by run_phase are added to the phase set first (see
+        prepare_phase_candidates). The query's candidates and the indexes the planner
+        used are stored in self.index_info[query]. Pass baseline_cost if already known.
         """
         try:
-            with self.conn.cursor() as cur:
-                # Load hypopg
-                try:
-                    cur.execute("CREATE EXTENSION IF NOT EXISTS hypopg")
-                    self.conn.commit()
-                except:
-                    pass
-                
-                if not tables or not columns:
-                    return None
-                
-                # Filter: only get columns that DON'T have existing indexes
-                new_columns = [col for col in columns if col not in self.existing_indexes]
-                
-                if not new_columns:
-                    # No new columns to index, return baseline cost
-                    return self.get_baseline_cost(query)
-                
-                # Get baseline cost first
+            if not tables or not columns:
+                return None
+            
+            # Get baseline cost first (unless the caller already has it)
+            if baseline_cost is None:
                 baseline_cost = self.get_baseline_cost(query)
+            
+            if baseline_cost is None or baseline_cost < self.cost_floor:
+                # Already cheap (seq scan is fine) - no index can help materially
+                return baseline_cost
+            
+            if query not in self._query_specs:
+                # Not prepared by run_phase (standalone call) - add it to the phase set
+                self._add_phase_candidates([(query, tables, columns)])
+            query_specs = {(table, tuple(cols)) for table, cols in self._query_specs.get(query, [])}
+            if not query_specs:
+                # No new columns to index, return baseline cost
+                return baseline_cost
+            
+            with self.conn.cursor() as cur:
+                # IMPORTANT: EXPLAIN must run in the SAME session that holds the indexes
+                phase_index_info = self._ensure_phase_indexes(cur)
+                hyp_index_info = [
+                    info for info in phase_index_info if (info[4], tuple(info[3])) in query_specs
+                ]  # List of (oid, index_name, size_bytes, columns, table)
                 
-                # Generate ALL combinations: single, pairs, triplets
-                # This gives the planner more options to find the best plan
-                all_combinations = []
-                
-                # Add all single columns
-                for col in new_columns:
-                    all_combinations.append([col])
-                
-                # Add all pairs of columns (2-column indexes)
-                if len(new_columns) >= 2:
-                    for combo in itertools.combinations(new_columns, 2):
-                        all_combinations.append(list(combo))
-                
-                # Add all triplets of columns (3-column indexes)
-                if len(new_columns) >= 3:
-                    for combo in itertools.combinations(new_columns, 3):
-                        all_combinations.append(list(combo))
-                
-                # Create hypothetical indexes on ALL tables x ALL combinations
-                # IMPORTANT: Do NOT commit between creating indexes and using them!
-                hyp_index_info = []  # List of (oid, index_name, size_bytes, columns)
-                index_count = 0
-                max_indexes = 50  # Limit to prevent overwhelming the planner
-                
-                for table in tables:
-                    if index_count >= max_indexes:
-                        break
-                    for combo in all_combinations:
-                        if index_count >= max_indexes:
-                            break
-                        try:
-                            cols_str = ", ".join(combo)
-                            create_stmt = f"CREATE INDEX ON {table} ({cols_str})"
-                            cur.execute(f"SELECT * FROM hypopg_create_index('{create_stmt}')")
-                            result = cur.fetchone()
-                            if result:
-                                oid = result[0]
-                                index_name = result[1]
-                                
-                                # Get hypothetical index size using hypopg_relation_size()
-                                try:
-                                    cur.execute(f"SELECT hypopg_relation_size({oid})")
-                                    size_result = cur.fetchone()
-                                    index_size = size_result[0] if size_result else 0
-                                except:
-                                    index_size = 0
-                                
-                                hyp_index_info.append((oid, index_name, index_size, combo, table))
-                                index_count += 1
-                        except Exception as e:
-                            pass
-                
-                # Get cost with ALL hypothetical indexes (in SAME session, before drop)
+                # Get cost with ALL hypothetical indexes of the phase
                 cost = None
                 used_indexes = []  # Will store which indexes were actually used
-                if hyp_index_info:  # Only run EXPLAIN if we actually created indexes
+                if phase_index_info:  # Only run EXPLAIN if we actually created indexes
                     try:
-                        # CRITICAL: Query must run while hypothetical indexes are active
-                        cur.execute(f"EXPLAIN (FORMAT JSON, VERBOSE) {query}")
+                        cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
                         result = cur.fetchone()
                         if result and result[0]:
                             plan = result[0]
                             cost = float(plan[0]['Plan']['Total Cost'])
                             
                             # Extract index names from the plan to see which were used
-                            plan_str = json.dumps(plan)
-                            for oid, index_name, index_size, cols, table in hyp_index_info:
+                            used_names = set()
+                            self._collect_index_names(plan[0]['Plan'], used_names)
+                            for oid, index_name, index_size, cols, table in phase_index_info:
                                 # Check if this index name appears in the EXPLAIN plan
-                                if index_name in plan_str:
+                                if index_name in used_names:
                                     used_indexes.append({
                                         'index_name': index_name,
                                         'columns': cols,
                                         'table': table,
                                         'size_bytes': index_size
                                     })
-                    except Exception as e:
-                        pass
-                
-                # Store index info in stats for analysis
-                if not hasattr(self, 'index_info'):
-                    self.index_info = {
-                        'all_created': [],    # All hypothetical indexes we created
-                        'used_by_query': []   # Which ones were actually used
-                    }
-                
-                self.index_info['all_created'] = [
-                    {
-                        'index_name': idx_name,
-                        'columns': cols,
-                        'table': tbl,
-                        'size_bytes': size
-                    }
-                    for oid, idx_name, size, cols, tbl in hyp_index_info
-                ]
-                self.index_info['used_by_query'] = used_indexes
-                
-                # Clean up ALL hypothetical indexes immediately after
-                for oid, _, _, _, _ in hyp_index_info:
-                    try:
-                        cur.execute(f"SELECT * FROM hypopg_drop_index({oid})")
-                    except:
-                        pass
-                
-                # Commit after cleanup
-                self.conn.commit()
+                    except psycopg2.Error:
+                        pass  # Fall back to the baseline cost below
                 
-                # If we got a cost, return it. Otherwise fall back to baseline
-                if cost is not None:
-                    return cost
-                else:
-                    return baseline_cost
-        except Exception as e:
+                # Store index info for analysis (keyed by query)
+                self.index_info[query] = {
+                    'all_created': hyp_index_info,  # (oid, name, size, columns, table) tuples
+                    'used_by_query': used_indexes   # Which ones were actually used
+                }
+            
+            # If we got a cost, return it. Otherwise fall back to baseline
+            if cost is not None:
+                return cost
+            else:
+                return baseline_cost
+        except psycopg2.Error:
             pass
         return None
     
+    def _measure_query(self, query, tables, columns):
+        """Get (baseline_cost, optimized_cost) for one query, None if it can't be measured"""
+        if not tables or not columns:
+            return None
+        # Get BASELINE cost (cached for the phase by prepare_phase_candidates)
+        baseline_cost = self.get_baseline_cost(query)
+        if baseline_cost is None:
+            return None
+        
+        # Get OPTIMIZED cost (with the selected hypothetical indexes)
+        # This also populates self.index_info[query] with used_by_query
+        optimized_cost = self.get_optimized_cost(query, tables, columns, baseline_cost)
+        if optimized_cost is None:
+            return None
+        return baseline_cost, optimized_cost
+    
     def get_phase_queries(self, phase_num):
         """Get queries for phase (different patterns for different phases) """
         if self.workload_id == 1:
@@ -388,34 +602,51 @@ class WorkloadRunner:
         print(f"{'='*80}")
         
         queries = self.get_phase_queries(phase_num)
-        start_time = time.time()
+        # Extract tables and columns once per query, not on every loop iteration
+        prepared = [
+            (query, self.extract_tables_from_query(query), self.extract_columns_from_query(query))
+            for query in queries
+        ]
+        self._baseline_cache.clear()  # Costs are only reused within a phase
+        self._result_cache.clear()
+        # Create the phase's hypothetical index candidates once, shared by all queries
+        self.prepare_phase_candidates(prepared)
+        # Monotonic clock, read once per iteration (wall-clock only for event timestamps)
+        start_time = time.monotonic()
+        current_time = start_time
         query_count = 0
-        all_hot_cols = set()
-        last_save_time = start_time
-        save_interval = 10  # Save every 10 seconds
+        all_hot_cols = {col for _, _, columns in prepared for col in columns}
+        # Status line: at most 10 updates/s, and only on a terminal
+        show_status = sys.stdout.isatty()
+        last_print = float('-inf')
         
-        while time.time() - start_time < duration_sec:
-            for query in queries:
-                # Extract tables and columns
-                tables = self.extract_tables_from_query(query)
-                columns = self.extract_columns_from_query(query)
-                
-                for col in columns:
-                    all_hot_cols.add(col)
-                
-                if not tables or not columns:
-                    continue
-                
-                # Get BASELINE cost
-                baseline_cost = self.get_baseline_cost(query)
-                if baseline_cost is None:
+        while current_time - start_time < duration_sec:
+            # Costs are deterministic for a fixed DB state: only re-measure queries whose
+            # cached result is missing or older than result_ttl_sec
+            stale = [
+                prepared_query for prepared_query in prepared
+                if current_time - self._result_cache.get(prepared_query[0], (float('-inf'),))[0] >= self.result_ttl_sec
+            ]
+            measured = set()
+            for query, tables, columns in stale:
+                result = self._measure_query(query, tables, columns)
+                if result is None:
+                    # Unmeasurable: remember when it was tried so it waits for the TTL too
+                    self._result_cache[query] = (current_time, None, None, [], 0)
                     continue
-                
-                # Get OPTIMIZED cost (with all hypothetical index combinations)
-                # This also populates self.index_info with used_by_query
-                optimized_cost = self.get_optimized_cost(query, tables, columns)
-                if optimized_cost is None:
+                # Get the indexes that were actually used
+                used_indexes = self.index_info[query]['used_by_query'] if query in self.index_info else []
+                used_size_bytes = sum(idx['size_bytes'] for idx in used_indexes)
+                self._result_cache[query] = (current_time, result[0], result[1], used_indexes, used_size_bytes)
+                measured.add(query)
+            
+            # Every query counts one execution per iteration, served from the cache
+            # between re-measurements
+            for query, tables, columns in prepared:
+                cached = self._result_cache.get(query)
+                if cached is None or cached[1] is None:
                     continue
+                _, baseline_cost, optimized_cost, used_indexes, used_size_bytes = cached
                 
                 # Calculate improvement based ONLY on indexes actually used
                 if baseline_cost > 0:
@@ -423,13 +654,18 @@ class WorkloadRunner:
                 else:
                     improvement_pct = 0
                 
-                # Get the indexes that were actually used
-                used_indexes = self.index_info['used_by_query'] if hasattr(self, 'index_info') else []
-                
                 # Aggregate: use query (trimmed) as key
                 query_key = query[:100]
                 
-                if query_key not in self.stats['queries']:
+                qid = self._qids.get(query_key)
+                if qid is None:
+                    qid = self._qids[query_key] = len(self._qids)
+                    self._agg_executions.append(0)
+                    self._agg_baseline.append(0.0)
+                    self._agg_optimized.append(0.0)
+                    self._agg_min_imp.append(100.0)
+                    self._agg_max_imp.append(-100.0)
+                    self._agg_index_size.append(0)
                     self.stats['queries'][query_key] = {
                         'full_query': query,
                         'tables': tables,
@@ -444,41 +680,57 @@ class WorkloadRunner:
                         'used_indexes': [],  # Track which indexes were actually used
                     }
                 
-                # Update aggregated stats
-                entry = self.stats['queries'][query_key]
-                entry['executions'] += 1
-                entry['total_baseline_cost'] += baseline_cost
-                entry['total_optimized_cost'] += optimized_cost
-                entry['min_improvement_pct'] = min(entry['min_improvement_pct'], improvement_pct)
-                entry['max_improvement_pct'] = max(entry['max_improvement_pct'], improvement_pct)
-                entry['avg_improvement_pct'] = ((entry['total_baseline_cost'] - entry['total_optimized_cost']) / 
-                                                 entry['total_baseline_cost'] * 100) if entry['total_baseline_cost'] > 0 else 0
+                # Update aggregated stats (numeric fields land in the entry on save)
+                self._agg_executions[qid] += 1
+                self._agg_baseline[qid] += baseline_cost
+                self._agg_optimized[qid] += optimized_cost
+                if improvement_pct < self._agg_min_imp[qid]:
+                    self._agg_min_imp[qid] = improvement_pct
+                if improvement_pct > self._agg_max_imp[qid]:
+                    self._agg_max_imp[qid] = improvement_pct
+                # Calculate total size only for indexes actually used
+                self._agg_index_size[qid] += used_size_bytes
                 
-                # Add index sizes and used indexes from this execution
-                if hasattr(self, 'index_info'):
-                    entry['used_indexes'] = self.index_info['used_by_query']
-                    # Calculate total size only for indexes actually used
-                    for idx in self.index_info['used_by_query']:
-                        entry['total_index_size_bytes'] += idx['size_bytes']
+                # Add used indexes from this execution
+                entry = self.stats['queries'][query_key]
+                # Only extend the used list when an index (table + columns) is new for this query
+                seen_keys = self._used_index_keys.setdefault(query_key, set())
+                for idx in used_indexes:
+                    key = (idx['table'], tuple(idx['columns']))
+                    if key not in seen_keys:
+                        seen_keys.add(key)
+                        entry['used_indexes'].append(idx)
                 
                 query_count += 1
                 
-                # Periodic save (every 10 seconds)
-                current_time = time.time()
-                if current_time - last_save_time >= save_interval:
-                    self.stats['hot_columns'] = sorted(list(all_hot_cols))
-                    self.save_stats()
-                    last_save_time = current_time
+                # Append fresh measurements to the events log (full stats are written per phase)
+                if query in measured:
+                    self.events_file.write(json.dumps({
+                        'run_time': self.stats['run_time'],  # Tells runs apart (file is appended to)
+                        'query_key': query_key,
+                        'phase': phase_num,
+                        'baseline': baseline_cost,
+                        'optimized': optimized_cost,
+                        'ts': time.time()
+                    }, separators=(',', ':')) + '\n')
                 
-                if query_count % 3 == 0:
+                if show_status and current_time - last_print >= 0.1:
                     elapsed = int(current_time - start_time)
                     hot_cols_str = ', '.join(sorted(list(all_hot_cols))[:3])
                     unique_queries = len(self.stats['queries'])
-                    print(f"  Time: {elapsed}s | Executions: {query_count} | Unique Queries: {unique_queries} | Hot cols: {hot_cols_str}...", end='\r')
+                    sys.stdout.write(f"  Time: {elapsed}s | Executions: {query_count} | Unique Queries: {unique_queries} | Hot cols: {hot_cols_str}...\r")
+                    sys.stdout.flush()
+                    last_print = current_time
+            
+            # Pace iterations at a fixed interval instead of spinning on cached results
+            next_iteration = min(current_time + self.iteration_interval_sec, start_time + duration_sec)
+            time.sleep(max(0.0, next_iteration - time.monotonic()))
+            current_time = time.monotonic()
         
         # Update stats
         self.stats['phases_completed'] += 1
         self.stats['hot_columns'] = sorted(list(all_hot_cols))
+        self.save_stats()  # Full aggregated stats at every phase boundary
         
         print(f"\n     Phase {phase_num} complete")
         print(f"    Total executions: {query_count}")
@@ -516,20 +768,42 @@ class WorkloadRunner:
                 print(f"  Hot columns: {', '.join(self.stats['hot_columns'][:5])}...")
                 print(f"{'='*80}\n")
     
+    def _flush_aggregates(self):
+        """Copy the per-qid aggregate columns into the self.stats['queries'] entries"""
+        queries = self.stats['queries']
+        for query_key, qid in self._qids.items():
+            entry = queries[query_key]
+            total_baseline = self._agg_baseline[qid]
+            total_optimized = self._agg_optimized[qid]
+            entry['executions'] = self._agg_executions[qid]
+            entry['total_baseline_cost'] = total_baseline
+            entry['total_optimized_cost'] = total_optimized
+            entry['min_improvement_pct'] = self._agg_min_imp[qid]
+            entry['max_improvement_pct'] = self._agg_max_imp[qid]
+            entry['avg_improvement_pct'] = ((total_baseline - total_optimized) /
+                                            total_baseline * 100) if total_baseline > 0 else 0
+            entry['total_index_size_bytes'] = self._agg_index_size[qid]
+    
     def save_stats(self):
-        """Save stats to JSON file (incremental, readable format)"""
+        """Save aggregated stats to JSON file (called at phase boundaries and on exit)"""
         filename = f"workload_{self.workload_id}_stats.json"
         try:
-            with open(filename, 'w') as f:
-                json.dump(self.stats, f, indent=2)  # Readable format with indentation
-            
+            self._flush_aggregates()
+            # Set before serializing so the saved file carries its own save time
             self.stats['last_save'] = datetime.now().isoformat()
+            if orjson:
+                data = orjson.dumps(self.stats)
+            else:
+                data = json.dumps(self.stats, separators=(',', ':')).encode()  # Compact format
+            with open(filename, 'wb') as f:
+                f.write(data)
             return True
         except Exception as e:
             print(f"\n      ERROR saving stats: {e}")
             return False
     
     def close(self):
+        self.events_file.close()
         self.conn.close()
 
 